@@ -1,11 +1,19 @@
+import os, pickle, tempfile, time
+from pathlib import Path
 import streamlit as st
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials
-from typing import List, Set
+from typing import Dict, FrozenSet, List, Set
 
 SPREADSHEET_ID = st.secrets["sheets"]["spreadsheet_id"]
 DEFAULT_TABS = list(st.secrets["sheets"].get("seminar_tabs", []))
 STUDENT_ID_COL = st.secrets["sheets"].get("student_id_col", "B")
+# Seconds; each TTL is shared by the in-process and on-disk caches
+CONFIG_TTL = 3600      # Settings tab rarely changes
+ATTENDANCE_TTL = 120
+CONFIG_CACHE_PATH = Path(tempfile.gettempdir()) / "mcp_config.pkl"
+ATTENDANCE_CACHE_PATH = Path(tempfile.gettempdir()) / "mcp_attendance.pkl"
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets.readonly",
@@ -17,63 +25,141 @@ gc = gspread.authorize(creds)
 st.set_page_config(page_title="MCP Attendance Checker", page_icon="✅", layout="centered")
 st.title("MCP Attendance Checker")
 
-@st.cache_data(ttl=120)  # refresh every 2 minutes
-def load_config_and_attendance():
+def _first_column(value_range: dict) -> List[str]:
+    """First column of a values.batchGet valueRange (requested with majorDimension=COLUMNS)."""
+    return (value_range.get("values") or [[]])[0]
+
+def _titles(sh) -> Set[str]:
+    # Batch reads fail as a whole if any range names a missing tab, so look up the titles first
+    return {ws.title for ws in sh.worksheets()}
+
+def _fetch_config():
     sh = gc.open_by_key(SPREADSHEET_ID)
 
     # Prefer Settings tab if it exists; else use secrets
     academic_year = ""
     tabs: List[str] = DEFAULT_TABS
-    try:
-        ws = sh.worksheet("Settings")
-        academic_year = (ws.acell("B1").value or "").strip()  # B1 next to "AcademicYear"
-        # Seminar tab list in A2:A if present
-        col = [v.strip() for v in ws.col_values(1)[1:] if v and v.strip()]
+    if "Settings" in _titles(sh):
+        # B1 (next to "AcademicYear") and the seminar tab list in A2:A, in one request
+        resp = sh.values_batch_get(
+            [absolute_range_name("Settings", "B1"), absolute_range_name("Settings", "A2:A")],
+            params={"majorDimension": "COLUMNS"},
+        )
+        year_vr, tabs_vr = resp.get("valueRanges", [{}, {}])
+        academic_year = (_first_column(year_vr)[:1] or [""])[0].strip()
+        col = [v.strip() for v in _first_column(tabs_vr) if v and v.strip()]
         if col:
             tabs = col
-    except gspread.WorksheetNotFound:
-        pass
-
-    # Load each tab's StudentID column into a set
-    out: dict[str, Set[str]] = {}
-    col_index = ord(STUDENT_ID_COL.upper()) - ord("A") + 1
-    for t in tabs:
-        try:
-            ws = sh.worksheet(t)
-            vals = ws.col_values(col_index)
-            ids = {v.strip() for v in vals if v and v.strip() and v.strip().lower() != "studentid"}
-            out[t] = ids
-        except gspread.WorksheetNotFound:
-            out[t] = set()  # tolerate a missing tab
-
-    return academic_year, tabs, out
-
-year_label, seminar_tabs, attendance = load_config_and_attendance()
+
+    return academic_year, tabs
+
+def _fetch_attendance(tabs: List[str]):
+    sh = gc.open_by_key(SPREADSHEET_ID)
+
+    # Load every tab's StudentID column into a set with a single values.batchGet
+    out: dict[str, FrozenSet[str]] = {t: frozenset() for t in tabs}  # tolerate a missing tab
+    titles = _titles(sh)
+    found = [t for t in tabs if t in titles]
+    if found:
+        col_range = f"{STUDENT_ID_COL.upper()}:{STUDENT_ID_COL.upper()}"
+        resp = sh.values_batch_get(
+            [absolute_range_name(t, col_range) for t in found],
+            params={"majorDimension": "COLUMNS"},
+        )
+        # valueRanges come back in request order
+        for t, vr in zip(found, resp.get("valueRanges", [])):
+            ids = set()
+            for v in _first_column(vr):
+                sid = v.strip() if v else ""  # strip each cell once
+                if sid and sid.lower() != "studentid":
+                    ids.add(sid)
+            out[t] = frozenset(ids)
+
+    return out
+
+def _read_disk_cache(path: Path, ttl: int):
+    """Snapshot from a previous process, if it is still fresh."""
+    try:
+        if time.time() - path.stat().st_mtime < ttl:
+            with path.open("rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass  # missing or half-written file: fall back to Sheets
+    return None
+
+def _write_disk_cache(path: Path, snapshot):
+    # Write to a temp file and rename so readers never see a partial pickle
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            pickle.dump(snapshot, f)
+        os.replace(tmp, path)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+
+def _build_presence(out: Dict[str, FrozenSet[str]]) -> Dict[str, FrozenSet[str]]:
+    """Invert tab -> IDs into student ID -> tabs attended."""
+    presence: Dict[str, Set[str]] = {}
+    for tab, ids in out.items():
+        for sid in ids:
+            presence.setdefault(sid, set()).add(tab)
+    return {sid: frozenset(ts) for sid, ts in presence.items()}
+
+# The disk snapshots survive restarts/redeploys; st.cache_data covers the hits within a process
+
+@st.cache_data(ttl=CONFIG_TTL)  # refresh every hour
+def load_config():
+    snapshot = _read_disk_cache(CONFIG_CACHE_PATH, CONFIG_TTL)
+    if snapshot is None:
+        snapshot = _fetch_config()
+        _write_disk_cache(CONFIG_CACHE_PATH, snapshot)
+    academic_year, tabs = snapshot
+    # Seminar tabs are usually numbered; sort numerically when they all are
+    try:
+        sorted_tabs = sorted(tabs, key=lambda x: int(x))
+    except ValueError:
+        sorted_tabs = sorted(tabs)
+    return academic_year, tabs, sorted_tabs
+
+@st.cache_data(ttl=ATTENDANCE_TTL)  # refresh every 2 minutes
+def load_attendance(tabs: tuple[str, ...]):
+    # The snapshot records which tabs it covers; a changed tab list means refetch
+    snapshot = _read_disk_cache(ATTENDANCE_CACHE_PATH, ATTENDANCE_TTL)
+    if snapshot is None or snapshot[0] != tabs:
+        snapshot = (tabs, _fetch_attendance(list(tabs)))
+        _write_disk_cache(ATTENDANCE_CACHE_PATH, snapshot)
+    out = snapshot[1]
+    return out, _build_presence(out)
+
+if st.button("Refresh now"):
+    CONFIG_CACHE_PATH.unlink(missing_ok=True)
+    ATTENDANCE_CACHE_PATH.unlink(missing_ok=True)
+    load_config.clear()
+    load_attendance.clear()
+
+year_label, seminar_tabs, sorted_tabs = load_config()
+attendance, presence = load_attendance(tuple(seminar_tabs))
 if year_label:
     st.caption(f"Academic year: **{year_label}**")
 
 st.subheader("Check your attendance")
-student_id = st.text_input("Enter your Student ID", placeholder="e.g., 21004335").strip()
+# A form only reruns the script on submit, not on every keystroke
+with st.form("check"):
+    student_id = st.text_input("Enter your Student ID", placeholder="e.g., 21004335").strip()
+    submitted = st.form_submit_button("Check")
 
-if student_id:
-    present_tabs = [t for t in seminar_tabs if student_id in attendance.get(t, set())]
+if submitted and student_id:
+    attended = presence.get(student_id, frozenset())
+    present_tabs = [t for t in sorted_tabs if t in attended]
     count = len(present_tabs)
     st.metric("Seminars attended", f"{count}")
 
     if present_tabs:
-        try:
-            present_tabs = sorted(present_tabs, key=lambda x: int(x))
-        except:
-            present_tabs.sort()
         with st.expander("Which seminars?"):
             st.write(", ".join(present_tabs))
 
     # Optional: full table view
-    try:
-        all_tabs = sorted(seminar_tabs, key=lambda x: int(x))
-    except:
-        all_tabs = sorted(seminar_tabs)
     st.write("Overview")
-    st.table([{"Seminar": t, "Present": "✅" if student_id in attendance.get(t, set()) else "—"} for t in all_tabs])
+    st.table([{"Seminar": t, "Present": "✅" if t in attended else "—"} for t in sorted_tabs])
 
 st.caption("Counts the number of seminars you have attended throughout this year.\n \nAny issues? Contact an MCP director.")
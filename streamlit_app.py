@@ -1,5 +1,6 @@
-import io, csv, datetime, streamlit as st
-from PIL import Image
+import io, csv, datetime, threading, streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from barcode import Code128
 from barcode.writer import ImageWriter
 from reportlab.pdfgen import canvas
@@ -12,10 +13,14 @@ ORG_NAME = "Medical Certificate Program"
 CARD_W, CARD_H = 3.5 * inch, 2.25 * inch     # wallet card size
 MARGIN_X, MARGIN_Y = 0.5 * inch, 0.5 * inch
 COLS, ROWS = 2, 4                             # 8 cards per Letter page
+PARALLEL_MIN_IDS = 5                          # below this, pool spin-up costs more than it saves
 
 # ---------- BARCODE ----------
-def make_code128(data: str) -> Image.Image:
-    """Generate a Code128 barcode as a PIL.Image."""
+# st.cache_data rather than functools.lru_cache: Streamlit re-executes this
+# script on every rerun, which would start a fresh lru_cache each time.
+@st.cache_data(max_entries=2048, show_spinner=False)
+def make_code128_png(data: str) -> bytes:
+    """Generate a Code128 barcode as PNG bytes (memoized per ID)."""
     code = Code128(str(data), writer=ImageWriter())
     fp = io.BytesIO()
     code.write(
@@ -28,73 +33,90 @@ def make_code128(data: str) -> Image.Image:
             "quiet_zone": 2,         # extra white space on sides
         },
     )
-    fp.seek(0)
-    return Image.open(fp).convert("RGB")
+    # ImageWriter already emits an RGB PNG, so hand those bytes on untouched
+    return fp.getvalue()
 
 # ---------- ID GENERATOR ----------
 def next_mcp_id_func(prefix="MCP", grad_year=None, start=1, taken=None):
     """
     Yields IDs like MCP-26-0001. Grad year is typically two digits.
-    'taken' is a set of already-used IDs to avoid collisions.
+    'taken' is a collection of already-used IDs to avoid collisions; numbering
+    continues after the highest taken ID with the same prefix/year.
     """
-    taken = set(taken or [])
     yy = (str(grad_year)[-2:] if grad_year else datetime.datetime.now().strftime("%y"))
     base = f"{prefix}-{yy}-"
-    n = start
+    used_nums = [int(t[len(base):]) for t in (taken or ()) if t.startswith(base) and t[len(base):].isdigit()]
+    n = max(start, max(used_nums, default=0) + 1)
     while True:
-        candidate = f"{base}{n:04d}"
-        if candidate not in taken:
-            yield candidate
+        yield f"{base}{n:04d}"
         n += 1
 
 # ---------- CARD RENDER ----------
-def draw_card(c, x, y, student_id, first, last, grad_year=None, logo_bytes: bytes | None = None):
-    """Draw a single card at (x,y) on the ReportLab canvas."""
-    # Border
-    c.roundRect(x, y, CARD_W, CARD_H, 10, stroke=1, fill=0)
-
-    # Text block (top-left)
+def render_card_assets(student_id) -> bytes:
+    """Rasterize the per-card images that don't need the canvas (the barcode PNG)."""
+    return make_code128_png(str(student_id))
+
+def render_all_assets(student_ids) -> dict:
+    """Render assets for each distinct ID, in a thread pool when there are enough of them."""
+    unique = list(dict.fromkeys(str(sid) for sid in student_ids))
+    if len(unique) < PARALLEL_MIN_IDS:
+        return {sid: render_card_assets(sid) for sid in unique}
+
+    # Workers need the script context to use st.cache_data without warnings
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as ex:
+        return dict(zip(unique, ex.map(render_card_assets, unique)))
+
+def draw_page(c, placed, assets, logo_reader: ImageReader | None = None):
+    """
+    Draw one page of cards on the ReportLab canvas.
+    placed: list of ((x, y), card) with (x, y) the card's bottom-left corner
+    assets: barcode PNG bytes keyed by str(card id), from render_all_assets
+    Cards are drawn in passes grouped by font, so each font is set once per page.
+    """
+    # Pass 1: borders and names
     c.setFont("Helvetica-Bold", 13)
-    c.drawString(x + 0.20 * inch, y + CARD_H - 0.35 * inch, f"{first} {last}".strip())
-    c.setFont("Helvetica", 10)
-    c.drawString(x + 0.20 * inch, y + CARD_H - 0.55 * inch, f"Student ID: {student_id}")
-    if grad_year:
-        c.drawString(x + 0.20 * inch, y + CARD_H - 0.72 * inch, f"Grad Year: {grad_year}")
-    c.setFont("Helvetica-Oblique", 9)
-    c.drawRightString(x + CARD_W - 0.12 * inch, y + 0.15 * inch, ORG_NAME)
+    for (x, y), card in placed:
+        c.roundRect(x, y, CARD_W, CARD_H, 10, stroke=1, fill=0)
+        c.drawString(x + 0.20 * inch, y + CARD_H - 0.35 * inch, f"{card['first']} {card['last']}".strip())
 
-    # Code128 barcode (large, centered near bottom)
-    bc_img = make_code128(student_id)
-    bc_buf = io.BytesIO(); bc_img.save(bc_buf, format="PNG"); bc_buf.seek(0)
+    # Pass 2: ID and grad year lines
+    c.setFont("Helvetica", 10)
+    for (x, y), card in placed:
+        c.drawString(x + 0.20 * inch, y + CARD_H - 0.55 * inch, f"Student ID: {card['id']}")
+        if card.get("grad_year"):
+            c.drawString(x + 0.20 * inch, y + CARD_H - 0.72 * inch, f"Grad Year: {card['grad_year']}")
 
+    # Pass 3: org name and images
+    c.setFont("Helvetica-Oblique", 9)
     bc_w_in = CARD_W - 0.40 * inch   # 0.20" margins on both sides
     bc_h_in = 0.80 * inch
-    bc_x = x + 0.20 * inch
-    bc_y = y + 0.4 * inch
-
-    c.drawImage(
-        ImageReader(bc_buf),
-        bc_x,
-        bc_y,
-        width=bc_w_in,
-        height=bc_h_in,
-        preserveAspectRatio=True,
-        mask='auto'
-    )
+    for (x, y), card in placed:
+        c.drawRightString(x + CARD_W - 0.12 * inch, y + 0.15 * inch, ORG_NAME)
 
-    # Optional logo (top-right)
-    if logo_bytes:
-        lb = io.BytesIO(logo_bytes); lb.seek(0)
+        # Code128 barcode (large, centered near bottom)
         c.drawImage(
-            ImageReader(lb),
-            x + CARD_W - 0.85 * inch,
-            y + CARD_H - 0.85 * inch,
-            width=0.80 * inch,
-            height=0.80 * inch,
+            ImageReader(io.BytesIO(assets[str(card["id"])])),
+            x + 0.20 * inch,
+            y + 0.4 * inch,
+            width=bc_w_in,
+            height=bc_h_in,
             preserveAspectRatio=True,
             mask='auto'
         )
 
+        # Optional logo (top-right)
+        if logo_reader is not None:
+            c.drawImage(
+                logo_reader,
+                x + CARD_W - 0.85 * inch,
+                y + CARD_H - 0.85 * inch,
+                width=0.80 * inch,
+                height=0.80 * inch,
+                preserveAspectRatio=True,
+                mask='auto'
+            )
+
 # ---------- PDF MAKER ----------
 def make_pdf(cards, logo_file=None) -> bytes:
     """
@@ -109,42 +131,35 @@ def make_pdf(cards, logo_file=None) -> bytes:
     c = canvas.Canvas(buf, pagesize=letter)
     page_w, page_h = letter
 
-    # Cache logo bytes once (UploadedFile is a stream)
-    logo_bytes = None
+    # Decode the logo once (UploadedFile is a stream); reusing the same
+    # ImageReader avoids re-parsing the PNG for every card
+    logo_reader = None
     if logo_file is not None:
         logo_bytes = logo_file.read()
-
-    i = 0
-    for card in cards:
-        col = i % COLS
-        row = (i // COLS) % ROWS
-
-        # Bottom-left of the card:
-        #  - start at page margin (MARGIN_X / MARGIN_Y)
-        #  - then add card width/height * col/row
-        #  - plus spacing for each gap already passed
-        x = MARGIN_X + col * (CARD_W + x_margin)
-        # for Y: subtract from top; only add y_margin after the first row
-        y = page_h - MARGIN_Y - (row + 1) * CARD_H - row * y_margin
-
-        draw_card(
-            c,
-            x,
-            y,
-            card["id"],
-            card["first"],
-            card["last"],
-            card.get("grad_year"),
-            logo_bytes=logo_bytes
+        if logo_bytes:
+            logo_reader = ImageReader(io.BytesIO(logo_bytes))
+
+    # Barcodes are independent of each other, so rasterize them all up front;
+    # the ReportLab canvas below stays single-threaded
+    assets = render_all_assets(card["id"] for card in cards)
+
+    # Bottom-left corner of each grid slot, shared by every page:
+    #  - start at page margin (MARGIN_X / MARGIN_Y)
+    #  - then add card width/height * col/row
+    #  - plus spacing for each gap already passed
+    #  - for Y: subtract from top; only add y_margin after the first row
+    per_page = COLS * ROWS
+    slots = [
+        (
+            MARGIN_X + col * (CARD_W + x_margin),
+            page_h - MARGIN_Y - (row + 1) * CARD_H - row * y_margin,
         )
+        for row in range(ROWS)
+        for col in range(COLS)
+    ]
 
-        i += 1
-        # new page after filling the grid
-        if i % (COLS * ROWS) == 0:
-            c.showPage()
-
-    # flush the last partially filled page
-    if i % (COLS * ROWS) != 0:
+    for start in range(0, len(cards), per_page):
+        draw_page(c, list(zip(slots, cards[start:start + per_page])), assets, logo_reader)
         c.showPage()
 
     c.save()
@@ -154,6 +169,9 @@ def make_pdf(cards, logo_file=None) -> bytes:
 st.set_page_config(page_title="MCP Card Generator", page_icon="🪪", layout="centered")
 st.title("MCP Card Generator")
 
+if st.sidebar.button("Clear barcode cache"):
+    make_code128_png.clear()
+
 tabs = st.tabs(["On-Demand", "Batch CSV"])
 
 # ---- On-Demand ----
@@ -218,29 +236,42 @@ with tabs[1]:
             ln_h = headers_lower["last name"]
             gy_h = headers_lower.get("grad year")  # optional
 
-            rows = list(reader)
-            used_ids = {(r.get(sid_h) or "").strip() for r in rows if (r.get(sid_h) or "").strip()}
-            gen = next_mcp_id_func(prefix, year2, start_seq, taken=used_ids)
-
+            # Single pass over the CSV: strip each field once and collect taken IDs,
+            # cards and the skipped count together
             cards = []
             updated_rows = []
-            for r in rows:
+            used_ids = set()
+            pending = []  # (row, card or None) waiting for an auto-assigned ID
+            missing = 0
+            for r in reader:
                 sid = (r.get(sid_h) or "").strip()
                 first = (r.get(fn_h) or "").strip()
                 last = (r.get(ln_h) or "").strip()
                 gy = (r.get(gy_h) or "").strip() if gy_h else ""
 
-                if not sid and auto_assign:
-                    sid = next(gen)
-                    r[sid_h] = sid  # write back so it ends up in the returned CSV
-
-                if sid and first and last:
-                    cards.append({"id": sid, "first": first, "last": last, "grad_year": gy})
+                card = {"id": sid, "first": first, "last": last, "grad_year": gy} if first and last else None
+                if sid:
+                    used_ids.add(sid)
+                elif auto_assign:
+                    pending.append((r, card))  # ID filled in below, once used_ids is complete
+                else:
+                    card = None
+
+                if card is not None:
+                    cards.append(card)
+                else:
+                    missing += 1
                 updated_rows.append(r)
 
-            missing = [r for r in rows if not ((r.get(sid_h) or "").strip() and (r.get(fn_h) or "").strip() and (r.get(ln_h) or "").strip())]
+            if pending:
+                gen = next_mcp_id_func(prefix, year2, start_seq, taken=used_ids)
+                for r, card in pending:
+                    r[sid_h] = next(gen)  # write back so it ends up in the returned CSV
+                    if card is not None:
+                        card["id"] = r[sid_h]
+
             if missing:
-                st.warning(f"{len(missing)} row(s) missing id/first/last were skipped for the PDF, but kept in the updated CSV.")
+                st.warning(f"{missing} row(s) missing id/first/last were skipped for the PDF, but kept in the updated CSV.")
 
             if st.button("Generate Batch PDF", type="primary"):
                 pdf_bytes = make_pdf(cards, logo_file=logo2)
@@ -251,14 +282,17 @@ with tabs[1]:
                     mime="application/pdf"
                 )
 
-                # Return updated CSV (with any auto-assigned IDs)
-                out_io = io.StringIO()
+                # Return updated CSV (with any auto-assigned IDs), encoding straight
+                # into a bytes buffer instead of building a str and encoding a copy
+                out_buf = io.BytesIO()
+                out_io = io.TextIOWrapper(out_buf, encoding="utf-8", newline="", write_through=True)
                 writer = csv.DictWriter(out_io, fieldnames=reader.fieldnames)
                 writer.writeheader()
                 writer.writerows(updated_rows)
+                out_io.detach()  # flush, and keep out_buf open when the wrapper is collected
                 st.download_button(
                     "Download Updated CSV (with IDs)",
-                    data=out_io.getvalue().encode("utf-8"),
+                    data=out_buf.getvalue(),
                     file_name="Students_With_IDs.csv",
                     mime="text/csv"
                 )